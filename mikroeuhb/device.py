@@ -17,13 +17,14 @@ class Command:
     
     stx, cmd, addr, counter = 0, 0, 0, 0
     _fmt = '<BBLH'  # Format of a command
+    _struct = struct.Struct(_fmt)
     
     @staticmethod
     def from_buf(buf):
         """Construct a Command object from a bytestring buf"""
         self = Command()
         self.stx, self.cmd, self.addr, self.counter = \
-            struct.unpack(self._fmt, buf[:8])
+            self._struct.unpack(buf[:self._struct.size])
         if self.stx != STX:
             logger.error('missing stx: ' + hexlify(buf))
         return self
@@ -37,7 +38,7 @@ class Command:
     
     def buf(self):
         """Return a bytestring containing a packet which can be sent via USB HID"""
-        buf = struct.pack(self._fmt, self.stx, self.cmd, self.addr, self.counter)
+        buf = self._struct.pack(self.stx, self.cmd, self.addr, self.counter)
         return buf.ljust(HID_buf_size, b'\x00')
     def send(self, f):
         """Send the command to a hidraw device"""
@@ -80,14 +81,46 @@ class Device:
     def __init__(self, fileObj):
         """Create a Device given a hidraw device file object"""
         self.f = fileObj
+        # Reusable buffer for send_cmd (report number, command, padding)
+        self._cmd_buf = bytearray(1 + HID_buf_size)
     def send(self, cmd):
         """Send a Command"""
         logger.debug('send cmd: ' + repr(cmd))
         cmd.send(self.f)
+    def send_cmd(self, cmd, addr=0, counter=0):
+        """Send a command given its attributes. Behaves like
+           send(Command.from_attr(cmd, addr, counter)), but packs the
+           command into a reusable buffer (mainly for writing the flash)."""
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('send cmd: ' + repr(Command.from_attr(cmd, addr, counter)))
+        Command._struct.pack_into(self._cmd_buf, 1, STX, cmd, addr, counter)
+        self.f.write(self._cmd_buf)
     def send_data(self, data):
-        """Send data (mainly for writing the flash)"""
+        """Send data (mainly for writing the flash). Data may be supplied
+           as a bytestring, bytearray or memoryview."""
         logger.debug('send data: ' + hexlify(data))
-        self.f.write(b'\x00' + data.ljust(HID_buf_size, b'\xff'))
+        self.f.write(b'\x00' + memoryview(data).tobytes().ljust(HID_buf_size, b'\xff'))
+    def send_data_many(self, pkts, dev_buf_size):
+        """Send a sequence of data packets following a WRITE command,
+           waiting for the ACKs sent by the device whenever its buffer
+           (of dev_buf_size bytes) gets full and when the command ends."""
+        send_data = self.send_data
+        dev_buf_rem = dev_buf_size
+        for pkt in pkts:
+            send_data(pkt)
+            dev_buf_rem -= len(pkt)
+            if dev_buf_rem == 0:
+                # Device sends an ACK whenever its buffer gets full.
+                # It must be read before sending any more data: the
+                # buffer has room for a single Flash block, and the
+                # firmware only empties it after programming the
+                # block, so the transfer cannot be pipelined.
+                self.recv().expect(Command.WRITE)
+                dev_buf_rem = dev_buf_size
+        if dev_buf_rem != dev_buf_size:
+            # Device also sends an ACK when the WRITE command ends
+            # (if it has not just been sent because of a full buffer)
+            self.recv().expect(Command.WRITE)
     def recv(self):
         """Receive a Command (mainly for checking ACKs)"""
         cmd = Command.recv(self.f)
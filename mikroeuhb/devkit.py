@@ -1,37 +1,97 @@
-import struct, logging
-from .util import hexlify, maketrans, bord
+import struct, logging, bisect
+from itertools import accumulate
+from .util import hexlify
 from .device import Device, Command, HID_buf_size
 logger = logging.getLogger(__name__)
 
-def encode_instruction(template, field=None, endianness='<'):
-    """Encodes a MCU instruction, returning it as a bytestring.
-       The template must be supplied as a string of bits, of
-       length 8, 16, 24 or 32. The template may contain lowercase
-       letters (a-z) which are substituted by a field (from the
-       most to the least significant bits). Endianness may be
-       specified using Python's struct module notation."""
-    _map = {8: 'B', 16: 'H', 24: 'L', 32: 'L'}
-    assert(len(template) in _map and endianness in '<>')
+_PACKERS = {}
+def _get_packer(endianness, nbits):
+    """Return a cached struct.Struct able to pack an instruction of
+       nbits bits (24 bits instructions are packed as 32 bits ones)"""
+    key = (endianness, nbits)
+    if key not in _PACKERS:
+        _map = {8: 'B', 16: 'H', 24: 'L', 32: 'L'}
+        _PACKERS[key] = struct.Struct(endianness + _map[nbits])
+    return _PACKERS[key]
+
+_L = struct.Struct('<L')
+_LL = struct.Struct('<LL')
+
+_TEMPLATES = {}
+def _compile_template(template):
+    """Parse an instruction template (see encode_instruction) only once,
+       returning a tuple (base, slots, nbits, width), where base is the
+       instruction with all letters replaced by zeros, slots is a tuple
+       of (field_shift, mask, instruction_shift) triples, one for each
+       run of consecutive letters, and width is the number of bits
+       expected in the field."""
+    if template in _TEMPLATES:
+        return _TEMPLATES[template]
+    nbits = len(template)
+    assert(nbits in (8, 16, 24, 32))
     a,z = map(ord, 'az')
-    max_c = 0
+    width = 0
     for c in template:
         if c not in '01':
             c = ord(c)
             if c < a or c > z:
                 raise ValueError('char "%c" disallowed in template' % c)
-            max_c = max(max_c, c - a + 1)
-    if max_c != 0:
+            width = max(width, c - a + 1)
+    base = 0
+    slots = []
+    prev_c = None
+    for i, c in enumerate(template):
+        instr_bit = nbits - 1 - i
+        if c in '01':
+            base |= int(c) << instr_bit
+            prev_c = None
+            continue
+        field_bit = width - 1 - (ord(c) - a)
+        if prev_c is not None and ord(c) == ord(prev_c) + 1:
+            # extend the current run of letters by one bit
+            mask = slots[-1][1]
+            slots[-1] = (field_bit, (mask << 1) | 1, instr_bit)
+        else:
+            slots.append((field_bit, 1, instr_bit))
+        prev_c = c
+    compiled = (base, tuple(slots), nbits, width)
+    _TEMPLATES[template] = compiled
+    return compiled
+
+def _fill_template(compiled, field=None):
+    """Substitute a field into a template previously compiled by
+       _compile_template, returning the instruction as an integer."""
+    base, slots, nbits, width = compiled
+    instruction = base
+    if width != 0:
         if field == None:
             raise ValueError('supplied template requires a field')
-        orig = ''.join([chr(a+i) for i in range(max_c)])
-        field = bin(field)[2:].rjust(max_c, '0')
-        template = template.translate(maketrans(orig, field))
-    instruction = int(template, 2)
-    instruction = struct.pack(endianness + _map[len(template)], instruction)
-    if len(template) == 24:
+        if field < 0 or field >> width:
+            raise ValueError('field 0x%x does not fit in %d bits' % (field, width))
+        for field_shift, mask, instr_shift in slots:
+            instruction |= ((field >> field_shift) & mask) << instr_shift
+    return instruction
+
+def _encode_compiled(compiled, field=None, endianness='<'):
+    """Encodes a MCU instruction from a template previously
+       compiled by _compile_template."""
+    assert(endianness in '<>')
+    nbits = compiled[2]
+    instruction = _fill_template(compiled, field)
+    instruction = _get_packer(endianness, nbits).pack(instruction)
+    if nbits == 24:
         instruction = instruction[:-1] if endianness == '<' else instruction[1:]
     return instruction
 
+def encode_instruction(template, field=None, endianness='<'):
+    """Encodes a MCU instruction, returning it as a bytestring.
+       The template must be supplied as a string of bits, of
+       length 8, 16, 24 or 32. The template may contain lowercase
+       letters (a-z) which are substituted by a field (from the
+       most to the least significant bits). Endianness may be
+       specified using Python's struct module notation."""
+    return _encode_compiled(_compile_template(template), field, endianness)
+
 # Print iterations progress
 def printProgressBar (iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█', printEnd = "\r"):
     """
@@ -59,6 +119,11 @@ class DevKitModel:
        A devkit class models the device Flash memory blocks, and also specifies
        any changes to the code needed for the bootloader to work."""
 
+    __slots__ = ('BootStart', 'EraseBlock', 'McuSize', 'blocks', 'blockaddr',
+                 '_blockstart', '_ptr')
+    """Devkit models hold a fixed set of attributes. Subclasses need to
+       declare their own (usually empty) __slots__ as well."""
+
     flash_mem_offset = 0
     """Offset in memory to which the Flash contents are mapped.
        This value is subtracted from the address supplied to self.write,
@@ -81,7 +146,12 @@ class DevKitModel:
         # buffer space in device (dev_buf_rem) may be broken.
         assert(self.EraseBlock % HID_buf_size == 0)
         self.blocks = {}
+        # Last Flash memory block to which data were written. Used to speed
+        # up block search based on data locality.
+        self._ptr = 0
         self._init_blockaddr()
+        # Start addresses of each block, for searching with bisect
+        self._blockstart = [start_addr for start_addr, end_addr in self.blockaddr]
 
     def _init_blockaddr(self):
         """Initialize blocks of size EraseBlock from address 0 to BootStart.
@@ -106,7 +176,7 @@ class DevKitModel:
         if blk not in self.blocks:
             start_addr, end_addr = self.blockaddr[blk]
             blk_len = end_addr - start_addr
-            self.blocks[blk] = bytearray(b'\xff' * blk_len)
+            self.blocks[blk] = bytearray(b'\xff') * blk_len
 
     def _write_addr(self, blk, blk_off=0):
         """Get the address of a block which needs to be supplied to the
@@ -127,43 +197,50 @@ class DevKitModel:
            supplied to WRITE."""
         return self._write_addr(blk)
 
-    _ptr = 0
-    """Last Flash memory block to which data were written. Used to speed
-       up block search based on data locality."""
-
     def _find_blk(self, addr):
         """Find the Flash block containing a given address."""
-        # Start searching from the last block written.
+        # Try first the last block written.
         blk = self._ptr
-        while True:
-            try:
-                start_addr, end_addr = self.blockaddr[blk]
-            except IndexError as err:
-                raise IndexError('invalid block %d at address 0x%x' % (
-                    blk, addr))
-            if addr >= end_addr:
-                blk += 1
-            elif addr < start_addr:
-                blk -= 1
-            else:
-                break
+        start_addr, end_addr = self.blockaddr[blk]
+        if not start_addr <= addr < end_addr:
+            blk = bisect.bisect_right(self._blockstart, addr) - 1
+            if blk < 0 or addr >= self.blockaddr[blk][1]:
+                raise IndexError('no block found at address 0x%x' % addr)
+            start_addr, end_addr = self.blockaddr[blk]
         self._ptr = blk
         return blk, start_addr, end_addr
 
     def _write_phy(self, addr, data):
         """Write a data bytestring or bytearray to a physical Flash
            memory address (relative to self.blockaddr)."""
+        # Slicing a memoryview does not copy the underlying data
+        data = memoryview(data)
+        pos = 0
+        while True:
+            blk, start_addr, end_addr = self._find_blk(addr)
+            # Write data to the block
+            self._lazy_block(blk)
+            write_len = min(end_addr - addr, len(data) - pos)
+            write_off = addr - start_addr
+            self.blocks[blk][write_off:write_off+write_len] = data[pos:pos+write_len]
+            # Check if any data is remaining which did not fit into the block
+            pos += write_len
+            if pos == len(data):
+                break
+            logger.debug('data trespassing block limits: addr=0x%x, write_len=0x%x' % (addr, write_len))
+            addr += write_len
+
+    def _phy_block(self, addr, size):
+        """Return the bytearray of the Flash block containing the physical
+           memory interval [addr, addr+size), lazily initializing it, and
+           the offset of addr inside the block. The interval must not cross
+           block limits."""
         blk, start_addr, end_addr = self._find_blk(addr)
-        # Write data to the block
+        if addr + size > end_addr:
+            raise IndexError('0x%x bytes at address 0x%x cross block limits' % (
+                size, addr))
         self._lazy_block(blk)
-        write_len = min(end_addr - addr, len(data))
-        write_off = addr - start_addr
-        self.blocks[blk][write_off:write_off+write_len] = data[:write_len]
-        # Check if any data is remaining which did not fit into the block
-        data = data[write_len:]
-        if len(data):
-            logger.debug('data trespassing block limits: addr=0x%x, write_len=0x%x' % (addr, write_len))
-            self._write_phy(addr + write_len, data)
+        return self.blocks[blk], addr - start_addr
 
     def _read_phy(self, addr, size):
         """Read a data bytestring from a physical Flash memory address."""
@@ -205,108 +282,131 @@ class DevKitModel:
         it = 0
         assert(isinstance(dev, Device))
         dev_buf_size = self.EraseBlock  # size of firmware's char[] fBuffer
+        write_max = self._write_max
+        num_blocks = end - start
         # Erase the Flash memory blocks
-        dev.send(Command.from_attr(Command.ERASE,
-                                   self._erase_addr(end - 1),
-                                   end - start))
+        dev.send_cmd(Command.ERASE, self._erase_addr(end - 1), num_blocks)
         dev.recv().expect(Command.ERASE)
         # Write each block blk
         for blk in range(start, end):
-            blk_data = self.blocks[blk]
+            # Blocks merged into the interval may not have been written
+            self._lazy_block(blk)
+            # Slices of the memoryview below are not copies of the block
+            blk_data = memoryview(self.blocks[blk])
             # Split the Flash memory block into parts containing _write_max bytes.
-            for blk_off in range(0, len(blk_data), self._write_max):
-                data = blk_data[blk_off:blk_off+self._write_max]
+            for blk_off in range(0, len(blk_data), write_max):
+                data = blk_data[blk_off:blk_off+write_max]
                 # Inform the device we are starting to send data
                 address = self._write_addr(blk, blk_off)
                 logger.debug('WRITE %d bytes to address 0x%x' % (
                     len(data), address))
-                printProgressBar(it, len(range(start, end)), prefix = 'Progress:', suffix = 'Complete', length = 50)
+                printProgressBar(it, num_blocks, prefix = 'Progress:', suffix = 'Complete', length = 50)
                 it+=1
-                dev.send(Command.from_attr(Command.WRITE, address, len(data)))
-                dev_buf_rem = dev_buf_size
+                dev.send_cmd(Command.WRITE, address, len(data))
                 # Split into USB HID packets
-                for i in range(0, len(data), HID_buf_size):
-                    pkt = data[i:i+HID_buf_size]
-                    dev.send_data(pkt)
-                    dev_buf_rem -= len(pkt)
-                    if dev_buf_rem == 0:
-                        # Device sends an ACK whenever its buffer gets full
-                        dev.recv().expect(Command.WRITE)
-                        dev_buf_rem = dev_buf_size
-                if dev_buf_rem != dev_buf_size:
-                    # Device also sends an ACK when the WRITE command ends
-                    # (if it has not just been sent because of a full buffer)
-                    dev.recv().expect(Command.WRITE)
+                dev.send_data_many([data[i:i+HID_buf_size] for i in
+                                    range(0, len(data), HID_buf_size)],
+                                   dev_buf_size)
+
+    merge_gap = 0
+    """Maximum number of unwritten blocks between two ranges of written
+       blocks for which both ranges are transferred as a single one, saving
+       an ERASE command. Unwritten blocks inside a merged range are erased
+       and programmed with 0xff, thus losing any previous contents."""
+
+    def _dirty_ranges(self):
+        """Return a list of intervals [start,end) of contiguous blocks
+           to which data were written, merging intervals separated by
+           at most merge_gap blocks."""
+        ranges = []
+        previous_end = None
+        previous_blk = None
+        for blk in sorted(self.blocks.keys()):
+            start_addr, end_addr = self.blockaddr[blk]
+            if start_addr == previous_end:
+                ranges[-1][1] = blk + 1
+            elif (previous_blk is not None and
+                  blk - previous_blk - 1 <= self.merge_gap and
+                  all(self.blockaddr[b][1] == self.blockaddr[b+1][0]
+                      for b in range(previous_blk, blk))):
+                ranges[-1][1] = blk + 1
+            else:
+                ranges.append([blk, blk + 1])
+            previous_end = end_addr
+            previous_blk = blk
+        return [tuple(interval) for interval in ranges]
 
     def transfer(self, dev):
         """Transfer to the device data which were written to this devkit model"""
         logger.debug('transfer to device starting')
         assert(isinstance(dev, Device))
-        # Find ranges of contiguous blocks to which data were written
-        blocks = sorted(self.blocks.keys())
-        if len(blocks) == 0:
-            return  # nothing to transfer
-        previous_end = self.blockaddr[blocks[0]][0]
-        frontier_blk = blocks[0]
-        previous_blk = blocks[0]
-        for blk in blocks:
-            start_addr, end_addr = self.blockaddr[blk]
-            if start_addr != previous_end:
-                self._blk_interval(dev, frontier_blk, previous_blk+1)
-                frontier_blk = blk
-            previous_end = end_addr
-            previous_blk = blk
-        self._blk_interval(dev, frontier_blk, previous_blk+1)
+        for start, end in self._dirty_ranges():
+            self._blk_interval(dev, start, end)
 
 
 class ARMDevKit(DevKitModel):
     """Implements bootloader fixes for all ARM-Thumb devkits"""
+    __slots__ = ()
     _supported = ['ARM', 'STELLARIS_M3', 'STELLARIS_M4', 'STELLARIS', 'TIVA_M4']
     """The devkits above appear to use the default Flash memory block model,
        thus only the bootloader fix needs to diverge from the base devkit model."""
+
+    _movw_r0 = _compile_template('0fgh0000ijklmnop11110e100100abcd')
+    _movt_r0 = _compile_template('0fgh0000ijklmnop11110e101100abcd')
+    """Templates for loading 16-bit halves into the r0 register,
+       compiled once when the class is defined."""
+    _mov_sp_r0 = _compile_template('0100011010000101')
+    _bx_r0 = _compile_template('0100011100000000')
+
+    _program = struct.Struct('<LLHLLH')
+    """Layout of the program put before BootStart: load r0 (movw, movt),
+       mov sp, r0, load r0 again, and bx r0."""
+
     def fix_bootloader(self, disable_bootloader=False):
         """Fix the first block to point the reset address to the bootloader.
            Put in the location expected by the bootloader a small ARM-Thumb
            program to initialize the stack pointer and to jump to the program
            being written."""
         reset_vec = self._read_phy(0, 8)
-        stackp, resetaddr = struct.unpack('<LL', reset_vec)
+        stackp, resetaddr = _LL.unpack(reset_vec)
         logger.debug('reset vector before fix: ' + hexlify(reset_vec))
         if resetaddr & 1 != 1:
             logger.warn('reset address 0x%x does not have a Thumb mark -- enforcing it' % resetaddr)
             resetaddr |= 1
         # Change the reset address to point to the bootloader code.
         if not disable_bootloader:
-            self._write_phy(4, struct.pack('<L', self.BootStart|1))
+            blk_data, blk_off = self._phy_block(4, _L.size)
+            _L.pack_into(blk_data, blk_off, self.BootStart|1)
         logger.debug('reset vector after fix:  ' + hexlify(self._read_phy(0, 8)))
 
         def load_r0(value):
             """Return ARM-Thumb instructions for loading a 32-bit value
                into the r0 register."""
-            return b''.join([
+            return (
                 # movw r0, #lo
-                encode_instruction('0fgh0000ijklmnop11110e100100abcd',
-                                   value & 0xffff),
+                _fill_template(self._movw_r0, value & 0xffff),
                 # movt r0, #hi
-                encode_instruction('0fgh0000ijklmnop11110e101100abcd',
-                                   (value >> 16) & 0xffff),
-            ])
-        program = b''.join([
-            load_r0(stackp),
-            encode_instruction('0100011010000101'),  # mov sp, r0
-            load_r0(resetaddr),
-            encode_instruction('0100011100000000'),  # bx r0
-            ])
-        assert(len(program) == 20)  # length expected by bootloader
-
-        logger.debug('start program routine: ' + hexlify(program))
-        self._write_phy(self.BootStart - len(program), program)
+                _fill_template(self._movt_r0, (value >> 16) & 0xffff),
+            )
+        program_len = self._program.size
+        assert(program_len == 20)  # length expected by bootloader
+        blk_data, blk_off = self._phy_block(self.BootStart - program_len,
+                                            program_len)
+        self._program.pack_into(blk_data, blk_off,
+            *(load_r0(stackp) +
+              (_fill_template(self._mov_sp_r0),) +  # mov sp, r0
+              load_r0(resetaddr) +
+              (_fill_template(self._bx_r0),)))      # bx r0
+
+        logger.debug('start program routine: ' +
+                     hexlify(blk_data[blk_off:blk_off+program_len]))
 
 
 class STM32DevKit(ARMDevKit):
     """Besides being ARM-Thumb devices, STM32s have a different Flash memory block model. See:
        http://www.mikroe.com/download/eng/documents/compilers/mikroc/pro/arm/help/flash_memory_library.htm#flash_addresstosector
     """
+    __slots__ = ()
     _supported = ['STM32L1XX', 'STM32F1XX', 'STM32F2XX', 'STM32F4XX']
     """STM32 MCUs are listed above"""
     flash_mem_offset = 0x8000000
@@ -317,17 +417,15 @@ class STM32DevKit(ARMDevKit):
         block_list = [(4,  16*1024),
                       (1,  64*1024),
                       (6, 128*1024)]
-        self.blockaddr = []
-        start_addr = 0
-        for number_of_blocks, block_size in block_list:
-            for i in range(number_of_blocks):
-                end_addr = start_addr + block_size
-                self.blockaddr.append((start_addr, end_addr))
-                start_addr = end_addr
-        assert(end_addr == self.BootStart)
+        block_sizes = [block_size for number_of_blocks, block_size in block_list
+                       for i in range(number_of_blocks)]
+        end_addrs = list(accumulate(block_sizes))
+        self.blockaddr = list(zip([0] + end_addrs[:-1], end_addrs))
+        assert(end_addrs[-1] == self.BootStart)
 
 
 class PIC18DevKit(DevKitModel):
+    __slots__ = ()
     _supported = ['PIC18', 'PIC18FJ']
 
     config_data_addr = 0x300000
@@ -347,6 +445,7 @@ class PIC18DevKit(DevKitModel):
 
 
 class PIC24DevKit(DevKitModel):
+    __slots__ = ()
     _supported = ['PIC24', 'DSPIC', 'DSPIC33']
 
     config_data_addr = 0x1f00008
@@ -383,16 +482,17 @@ class PIC24DevKit(DevKitModel):
         if addr >= self.config_data_addr:
             return
         assert(len(data) % 4 == 0)
-        newd = []
+        newd = bytearray(data)
         # discard padding bytes (at every fourth byte)
-        for i in range(0, len(data), 4):
-            newd += list(data[i:i+3])
-            padbyte = bord(data[i+3])
-            if padbyte != 0:
-                logger.warning('padding byte at addr 0x%x (%02X) is not null' %
-                               (addr+i+3, padbyte))
+        padding = newd[3::4]
+        if padding.count(b'\x00') != len(padding):
+            for i, padbyte in enumerate(padding):
+                if padbyte != 0:
+                    logger.warning('padding byte at addr 0x%x (%02X) is not null' %
+                                   (addr+4*i+3, padbyte))
+        del newd[3::4]
         # write the new data array
-        self._write_phy(self._hex_addr_to_phy(addr), bytearray(newd))
+        self._write_phy(self._hex_addr_to_phy(addr), newd)
 
     def fix_bootloader(self, disable_bootloader=False):
         jump_to_main_prog = self._read_phy(0, 6)
@@ -411,6 +511,7 @@ class PIC24DevKit(DevKitModel):
 
 
 class PIC32DevKit(DevKitModel):
+    __slots__ = ()
     _supported = ['PIC32']
 
     main_flash_addr = 0x1d000000
@@ -488,23 +589,28 @@ class PIC32DevKit(DevKitModel):
                          hexlify(jump_bootstart_code))
             
 class PIC32MZDevKit(PIC32DevKit):
+    __slots__ = ()
     _supported = ['PIC32MZ']
 
     boot_rom_addr   = 0x1fc00000
 
     config_data_addr = boot_rom_addr | 0xff00  # configuration bits
 
-_map = {}
+def _init_map():
+    """Map each supported mcu to the devkit class implementing it"""
+    _map = {}
+    for cls in globals().values():
+        if hasattr(cls, '_supported'):
+            for mcu in cls._supported:
+                # a mcu cannot be supported by two different classes
+                assert(mcu not in _map)
+                _map[mcu] = cls
+    return _map
+_map = _init_map()
+
 def factory(bootinfo):
     """Factory for constructing devkit objects from a bootinfo dictionary"""
-    if len(_map) == 0:
-        for clsname, cls in globals().items():
-            if hasattr(cls, '_supported'):
-                for mcu in cls._supported:
-                    # a mcu cannot be supported by two different classes
-                    assert(mcu not in _map)
-                    _map[mcu] = cls
     mcu = bootinfo['McuType']
     if not mcu in _map:
-        raise NotImplemented('support for this devkit is not yet implemented')
+        raise NotImplementedError('support for this devkit is not yet implemented')
     return _map[mcu](bootinfo)
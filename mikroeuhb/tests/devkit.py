@@ -19,6 +19,12 @@ class EncodeInstr(unittest.TestCase):
             lambda: devkit.encode_instruction('0000000a'))
         self.assertRaises(ValueError,
             lambda: devkit.encode_instruction('0000000-', '1'))
+        self.assertRaises(ValueError,
+            lambda: devkit.encode_instruction('000000ab', 4))
+        self.assertEqual(devkit.encode_instruction('1ab0cdef', 0x2b), b'\xcb')
+        self.assertEqual(devkit.encode_instruction('00000100abcdefghijklmnop',
+                                                   0x1234, '>'),
+                         unhexlify('041234'))
 
 class STM32Factory(unittest.TestCase):
     """Check if the bootinfo dictionary is correctly identified for STM32 devices"""
@@ -28,6 +34,14 @@ class STM32Factory(unittest.TestCase):
             bootinfo['McuType'] = mcu
             self.assertIsInstance(devkit.factory(bootinfo), devkit.STM32DevKit)
 
+class UnsupportedFactory(unittest.TestCase):
+    """Check if the factory fails correctly for unsupported devices"""
+    def runTest(self):
+        bootinfo = dict(_stm32)
+        bootinfo['McuType'] = 'UNKNOWN'
+        self.assertRaises(NotImplementedError,
+            lambda: devkit.factory(bootinfo))
+
 class STM32Bootloader(unittest.TestCase):
     """The beginning of the first block, and the end of the last block before
     bootloader must be modified correctly in STM32 devices"""
@@ -51,6 +65,73 @@ class STM32IndexError(unittest.TestCase):
         self.assertRaises(IndexError,
             lambda: kit.write(0x08000000 + _stm32['BootStart'], b'\xff'))
 
+class STM32LazyBlocks(unittest.TestCase):
+    """Only Flash blocks to which data were written may be allocated"""
+    def runTest(self):
+        kit = devkit.factory(_stm32)
+        kit.write(0x08000010, b'\x00' * 16)
+        self.assertEqual(kit._read_phy(0x20000, 4), b'\xff' * 4)
+        self.assertEqual(list(kit.blocks.keys()), [0])
+
+class STM32DirtyRanges(unittest.TestCase):
+    """Written blocks must be grouped into ranges of contiguous blocks"""
+    def runTest(self):
+        kit = devkit.factory(_stm32)
+        self.assertEqual(kit._dirty_ranges(), [])
+        for blk in [0, 1, 3, 6, 5]:
+            kit.write(0x08000000 + kit.blockaddr[blk][0], b'\x00')
+        self.assertEqual(kit._dirty_ranges(), [(0, 2), (3, 4), (5, 7)])
+
+class MergingSTM32DevKit(devkit.STM32DevKit):
+    __slots__ = ()
+    merge_gap = 1
+
+class STM32MergeGap(unittest.TestCase):
+    """Ranges of written blocks separated by up to merge_gap blocks must
+    be merged into a single range"""
+    def runTest(self):
+        kit = MergingSTM32DevKit(_stm32)
+        for blk in [0, 2, 3, 6]:
+            kit.write(0x08000000 + kit.blockaddr[blk][0], b'\x00')
+        self.assertEqual(kit._dirty_ranges(), [(0, 4), (6, 7)])
+        self.assertEqual(list(sorted(kit.blocks.keys())), [0, 2, 3, 6])
+
+_dspic33 = {
+    'McuType': 'DSPIC33',
+    'EraseBlock': 0xc00,
+    'BootStart': 0x2a800,
+    'McuSize': 0x2ac00
+}
+
+class DSPIC33Padding(unittest.TestCase):
+    """Every fourth byte in a DSPIC33 hexfile is a padding byte which must
+    be discarded, and which is expected to be null"""
+    def runTest(self):
+        kit = devkit.factory(_dspic33)
+        kit.write(0x10, unhexlify('0102030004050600'))
+        self.assertEqual(kit._read_phy(0xc, 6), unhexlify('010203040506'))
+        self.assertRaises(logexception.LogException,
+            lambda: kit.write(0x18, unhexlify('0708090a')))
+
+_pic32 = {
+    'McuType': 'PIC32',
+    'EraseBlock': 0x1000,
+    'BootStart': 0x9d07c000,
+    'McuSize': 0x80000
+}
+
+class PIC32IndexError(unittest.TestCase):
+    """PIC32 Flash memory is split in two non-contiguous ranges. Test if we
+    fail correctly when writing between them"""
+    def runTest(self):
+        kit = devkit.factory(_pic32)
+        kit.write(kit.boot_rom_addr, b'\xff')
+        self.assertRaises(IndexError,
+            lambda: kit.write(kit.main_flash_addr + _pic32['McuSize'], b'\xff'))
+        kit.write(kit.main_flash_addr, b'\x00')
+        self.assertRaises(IndexError,
+            lambda: kit.write(kit.boot_rom_addr - 1, b'\xff'))
+
 class STM32FullFlashBlock(unittest.TestCase):
     """Try to fill the entire flash randomly and assert data does not corrupt
     in the flash-block representation"""
@@ -90,6 +171,7 @@ class STM32RandomWrites(unittest.TestCase):
                              bytes(randmem))
 
 load_tests = repeatable.make_load_tests([
-    EncodeInstr, STM32Factory, STM32Bootloader, STM32IndexError,
-    STM32FullFlashBlock, STM32RandomWrites
+    EncodeInstr, STM32Factory, UnsupportedFactory, STM32Bootloader,
+    STM32IndexError, STM32LazyBlocks, STM32DirtyRanges, STM32MergeGap,
+    DSPIC33Padding, PIC32IndexError, STM32FullFlashBlock, STM32RandomWrites
 ])
\ No newline at end of file